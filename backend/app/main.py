@@ -7,12 +7,14 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from app.routes import analysis, ocr, health, chat, general_chat, history
 from app.database import init_db
+from app.services.rag_service import warmup
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -44,6 +46,9 @@ app.include_router(history.router, prefix="/api/history", tags=["History"])
 @app.on_event("startup")
 async def startup_event():
     init_db()
+    if os.getenv("WARMUP_ON_STARTUP", "1") == "1":
+        # Background thread: the server accepts requests while the embedder loads
+        threading.Thread(target=warmup, daemon=True).start()
 
 # Root endpoint
 @app.get("/")
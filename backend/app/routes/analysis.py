@@ -3,16 +3,43 @@ Clinical analysis endpoints
 """
 
 from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 import json
 
 from app.models.schemas import AnalysisRequest, AnalysisResponse
-from app.services.rag_service import analyze_clinical_note
-from app.database import get_db
+from app.services.rag_service import analyze_clinical_note, stream_clinical_note_analysis
+from app.database import get_db, SessionLocal
 from app.models.db_models import AnalysisRecord
 
 router = APIRouter()
 
+def _save_to_history(db: Session, request: AnalysisRequest, result: dict) -> None:
+    """Persist an analysis result for dashboard history; failures are logged, never raised"""
+    try:
+        primary_dx = None
+        confidence = None
+        if result.get("ddx") and len(result["ddx"]) > 0:
+            primary_dx = result["ddx"][0].get("diagnosis")
+            confidence = result["ddx"][0].get("confidence")
+        
+        record = AnalysisRecord(
+            note_preview=request.text[:200] if request.text else "",
+            full_note=request.text,
+            soap=result.get("soap", ""),
+            ddx_json=json.dumps(result.get("ddx")) if result.get("ddx") else None,
+            step1_facts=result.get("step1_facts", ""),
+            primary_diagnosis=primary_dx,
+            confidence=confidence,
+            processing_time=result.get("processing_time", 0),
+            llm_mode=request.llm_mode
+        )
+        db.add(record)
+        db.commit()
+    except Exception as save_error:
+        # Don't fail the request if save fails, just log
+        print(f"Warning: Failed to save analysis to history: {save_error}")
+
 @router.post("/analyze", response_model=AnalysisResponse)
 async def analyze_note(request: AnalysisRequest, db: Session = Depends(get_db)):
     """
@@ -32,35 +59,46 @@ async def analyze_note(request: AnalysisRequest, db: Session = Depends(get_db)):
         )
         
         # Auto-save to database for history
-        try:
-            primary_dx = None
-            confidence = None
-            if result.get("ddx") and len(result["ddx"]) > 0:
-                primary_dx = result["ddx"][0].get("diagnosis")
-                confidence = result["ddx"][0].get("confidence")
-            
-            record = AnalysisRecord(
-                note_preview=request.text[:200] if request.text else "",
-                full_note=request.text,
-                soap=result.get("soap", ""),
-                ddx_json=json.dumps(result.get("ddx")) if result.get("ddx") else None,
-                step1_facts=result.get("step1_facts", ""),
-                primary_diagnosis=primary_dx,
-                confidence=confidence,
-                processing_time=result.get("processing_time", 0),
-                llm_mode=request.llm_mode
-            )
-            db.add(record)
-            db.commit()
-        except Exception as save_error:
-            # Don't fail the request if save fails, just log
-            print(f"Warning: Failed to save analysis to history: {save_error}")
+        _save_to_history(db, request, result)
         
         return AnalysisResponse(**result)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+@router.post("/analyze/stream")
+async def analyze_note_stream(request: AnalysisRequest):
+    """
+    Streaming variant of /analyze
+    Emits newline-delimited JSON events as pipeline stages finish, so the client can
+    render retrieved evidence, facts, SOAP and each diagnosis while generation continues.
+    The last event is "result" (same shape as AnalysisResponse) or "error"
+    """
+    if not request.text or request.text.strip() == "":
+        raise HTTPException(status_code=400, detail="Clinical note text is required")
+    
+    async def event_lines():
+        try:
+            async for event in stream_clinical_note_analysis(
+                full_text=request.text,
+                llm_mode=request.llm_mode,
+                top_k=request.top_k,
+                use_small_embedder=request.use_small_embedder
+            ):
+                if event["event"] == "result":
+                    # Own session: a Depends(get_db) session is closed before the response body is streamed
+                    db = SessionLocal()
+                    try:
+                        _save_to_history(db, request, event["data"])
+                    finally:
+                        db.close()
+                    event = {"event": "result", "data": AnalysisResponse(**event["data"]).model_dump()}
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            yield json.dumps({"event": "error", "data": f"Analysis failed: {str(e)}"}) + "\n"
+    
+    return StreamingResponse(event_lines(), media_type="application/x-ndjson")
+
 @router.get("/test")
 async def test_endpoint():
     """Test endpoint to verify API is working"""
@@ -69,6 +107,7 @@ async def test_endpoint():
         "message": "Analysis API is operational",
         "endpoints": {
             "analyze": "/api/analysis/analyze",
+            "analyze_stream": "/api/analysis/analyze/stream",
             "test": "/api/analysis/test"
         }
     }
@@ -15,6 +15,8 @@ async def chat_endpoint(request: ChatRequest):
     
     Allows users to ask follow-up questions about their analysis.
     Requires the full analysis context to be sent with each request.
+    Retrieval always uses the small (MiniLM) embedder, as the frontend's analyses do; an analysis
+    run with use_small_embedder=false gets its chunks re-embedded (and truncated to 256 tokens)
     """
     try:
         if not request.question or request.question.strip() == "":
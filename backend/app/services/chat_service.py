@@ -2,11 +2,9 @@
 Chat service for interactive RAG-based Q&A about analyzed clinical notes
 """
 
+import asyncio
 import time
 from typing import List, Dict, Any
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 
 from app.services.rag_service import (
     get_embedder,
@@ -21,7 +19,8 @@ async def chat_with_note(
     analysis_context: Dict[str, Any],
     chat_history: List[Dict[str, str]],
     llm_mode: str = "local_stub",
-    top_k: int = 3
+    top_k: int = 3,
+    use_small_embedder: bool = True
 ) -> Dict[str, Any]:
     """
     Interactive chat about an analyzed clinical note
@@ -32,6 +31,9 @@ async def chat_with_note(
         chat_history: Previous Q&A pairs
         llm_mode: LLM mode to use
         top_k: Number of chunks to retrieve
+        use_small_embedder: Embedder the note was analyzed with. The chunks (token windows sized
+            to that model) and the cached index are only reused when chat embeds with the same one.
+            The chat endpoint uses the default small model, matching the frontend's analyses
     
     Returns:
         Dict with answer, relevant_chunks, and sources
@@ -50,18 +52,22 @@ async def chat_with_note(
             "sources": []
         }
     
-    # Get embedder and rebuild index from stored chunks
-    embedder = get_embedder(use_small=False)
-    index, id_map, _ = build_index_from_chunks(all_chunks, embedder)
-    
-    # Retrieve relevant chunks for the question
-    retrieved = retrieve_from_index(
-        query=question,
-        embedder=embedder,
-        index=index,
-        id_map=id_map,
-        top_k=top_k
-    )
+    def retrieve() -> List[Dict[str, Any]]:
+        # Get embedder and rebuild index from stored chunks
+        embedder = get_embedder(use_small=use_small_embedder)
+        index, id_map, _ = build_index_from_chunks(all_chunks, embedder)
+        
+        # Retrieve relevant chunks for the question
+        return retrieve_from_index(
+            query=question,
+            embedder=embedder,
+            index=index,
+            id_map=id_map,
+            top_k=top_k
+        )
+    
+    # Off the event loop, so concurrent questions' encodes can be batched together
+    retrieved = await asyncio.to_thread(retrieve)
     
     # Build context for LLM
     context_parts = []
@@ -78,10 +84,8 @@ async def chat_with_note(
         context_parts.append(f"\nDifferential Diagnoses:\n{ddx_text}")
     
     # Add retrieved chunks
-    chunk_context = []
-    for r in retrieved:
-        chunk_context.append(f"[{r['chunk_id']}] ({r['section']}): {r['text']}")
-    context_parts.append(f"\nRelevant Evidence:\n" + "\n\n".join(chunk_context))
+    chunk_context = "\n\n".join(f"[{r['chunk_id']}] ({r['section']}): {r['text']}" for r in retrieved)
+    context_parts.append(f"\nRelevant Evidence:\n{chunk_context}")
     
     full_context = "\n\n".join(context_parts)
     
@@ -5,23 +5,44 @@ Includes embeddings, FAISS indexing, and LLM reasoning
 
 import os
 import re
+import asyncio
 import json
-import uuid
 import time
-from typing import List, Dict, Any, Tuple
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Tuple, Optional, Iterable, Iterator, AsyncIterator, Generator
 import numpy as np
 import requests
 
-# ML imports
-from sentence_transformers import SentenceTransformer
-import faiss
+# ML imports are deferred to first use (sentence_transformers pulls in torch + transformers), so
+# importing this module stays cheap; the startup warmup thread loads them in the background
+# unless WARMUP_ON_STARTUP=0, in which case short local_stub-only notes never pay for them
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 # Configuration
 EMBED_MODEL = "sentence-transformers/all-mpnet-base-v2"
-EMBED_MODEL_SMALL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_MODEL_SMALL = "sentence-transformers/all-MiniLM-L6-v2"  # Default: ~4x faster encode than mpnet
+# int8 ONNX graph used when EMBEDDER_BACKEND=onnx; the AVX2 build runs on any x86 CPU, use
+# onnx/model_qint8_avx512_vnni.onnx (or onnx/model_qint8_arm64.onnx) to match the host
+EMBED_ONNX_INT8_FILE = os.getenv("EMBEDDER_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
 EMBED_DIM = 768
 EMBED_DIM_SMALL = 384
 COLAB_T4_URL = "https://a92c-34-16-161-55.ngrok-free.app/generate"
+SHORT_NOTE_CHARS = 6000  # Notes below this fit in the LLM context whole, so retrieval is skipped
+INDEX_CACHE_SIZE = 32  # Per-note FAISS indexes kept in memory
+CHUNK_CACHE_SIZE = 32  # Per-note chunk lists kept in memory
+LLM_CACHE_SIZE = 256  # Deterministic LLM responses kept in memory
+FAISS_MIN_CHUNKS = 2048  # Below this, a NumPy matmul over the embeddings beats a FAISS index
+FAISS_HNSW_MIN_CHUNKS = 50000  # Above this, exact scans give way to an HNSW graph (sublinear search)
+HNSW_M = 32  # Graph neighbours per node
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR")  # If set, per-note indexes also persist here across restarts
+EMBED_BATCH_SIZE = 64  # encode() length-sorts its inputs, so larger batches add little padding
+EMBED_BATCH_SIZE_GPU = 128  # GPU matmul kernels need bigger batches to saturate
 
 # Section headers
 SECTION_HEADERS = [
@@ -40,29 +61,161 @@ SECTION_HEADERS = [
     r"ALLERGIES[:\s]*",
     r"ROS[:\s]*",
 ]
+SECTION_PATTERN = re.compile("(" + "|".join(SECTION_HEADERS) + ")", re.IGNORECASE)
+
+# Local stub: a prompt line plus the first [bracketed] id on it
+CHUNK_LINE_RE = re.compile(r"^[^\[\n]*\[([^\]\n]*)\][^\n]*", re.MULTILINE)
+QUESTION_RE = re.compile(r'USER QUESTION: (.*)', re.IGNORECASE)
+CONTEXT_BEFORE_HISTORY_RE = re.compile(r'CONTEXT:\n(.*?)CHAT HISTORY', re.DOTALL)
+CONTEXT_BEFORE_QUESTION_RE = re.compile(r'CONTEXT:\n(.*?)USER QUESTION', re.DOTALL)
+AGE_RE = re.compile(r'(\d+)[- ]year[s]?[- ]old')
+MALE_RE = re.compile(r'\bmale\b')
+FEMALE_RE = re.compile(r'\bfemale\b')
+
+# LLM output cleanup for the DDx JSON step
+CODE_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*$", re.IGNORECASE | re.MULTILINE)
+# Matches a whole string literal (kept as-is) or a trailing comma before ] / } (dropped), so
+# commas inside string values such as a rationale's ", ]" are never rewritten
+TRAILING_COMMA_RE = re.compile(r'"(?:\\.|[^"\\])*"|,\s*([\]}])')
+
+# Clinical keywords the local stub looks for; matched as plain substrings of the lowered prompt
+STUB_KEYWORDS = frozenset({
+    "168", "abdominal pain", "ache", "altered", "belly pain", "blood pressure", "bnp", "bp",
+    "brudzinski", "cardiomegaly", "chest discomfort", "chest pain", "chronic kidney", "ckd",
+    "confusion", "cough", "crackles", "diabetes", "diabetic", "disoriented", "dm", "dyspnea",
+    "edema", "febrile", "fever", "headache", "hypertension", "jugular", "jvd", "jvp", "kernig",
+    "leg swelling", "meningeal", "meningitis", "nausea", "neck stiffness", "nuchal",
+    "nuchal rigidity", "orthopnea", "pain", "pitting", "pulmonary congestion", "pulmonary edema",
+    "rales", "renal", "shortness of breath", "sob", "stomach pain", "swelling", "temp",
+    "temperature", "troponin", "vomiting", "wbc", "white blood", "white blood cell"
+})
+
+# JSON schema for the Step 2 DDx array, used by providers that support constrained decoding
+DDX_JSON_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "diagnosis": {"type": "string"},
+            "confidence": {"type": "string", "enum": ["High", "Medium", "Low"]},
+            "rationale": {"type": "string"},
+            "evidence": {"type": "array", "items": {"type": "string"}},
+            "workup": {"type": "string"},
+            "red_flags": {"type": "string"}
+        },
+        "required": ["diagnosis", "confidence", "rationale", "evidence"]
+    }
+}
+
+# Step 1 extraction, Step 2 DDx and SOAP note returned together from one structured-output call;
+# property order is generation order, so the DDx is reasoned from the extraction written before it
+FUSED_ANALYSIS_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "extraction": {"type": "string"},
+        "ddx": DDX_JSON_SCHEMA,
+        "soap": {"type": "string"}
+    },
+    "required": ["extraction", "ddx", "soap"]
+}
+
+# Modes with schema-constrained output, where one fused call beats paying the context prefill three times
+# (Groq's JSON mode guarantees a valid top-level object, though not its shape: see _is_fused_analysis)
+FUSED_LLM_MODES = {"ollama", "groq"}
 
 # Global model cache
 _embedder_cache = {}
+_embedder_lock = threading.Lock()  # Retrieval runs in worker threads; load each model once
+
+# Per-note index cache: (embedder id, hash of chunk texts) -> (index, note embedding)
+_index_cache: "OrderedDict[Tuple[int, str], Tuple[Any, np.ndarray]]" = OrderedDict()
+_index_cache_lock = threading.Lock()  # Indexes are built in worker threads; LRU reorder/evict must be atomic
 
-def get_embedder(use_small: bool = False) -> SentenceTransformer:
+# Exact-prompt LLM response cache: sha256 of (mode, model, prompts, params) -> response
+_llm_cache: "OrderedDict[str, str]" = OrderedDict()
+_llm_cache_lock = threading.Lock()  # Step 1 / Step 2 and SOAP calls run in concurrent threads
+
+# Shared HTTP session: keep-alive connections to Ollama / the Colab tunnel instead of a
+# fresh TCP (+TLS for ngrok) handshake per LLM call
+_http_session = requests.Session()
+
+def get_embedder(use_small: bool = True) -> "SentenceTransformer":
     """Get or load embedding model with caching"""
-    global _embedder_cache
-    
     key = "small" if use_small else "large"
     
-    if key not in _embedder_cache:
-        model_name = EMBED_MODEL_SMALL if use_small else EMBED_MODEL
-        _embedder_cache[key] = SentenceTransformer(model_name)
+    with _embedder_lock:
+        if key not in _embedder_cache:
+            _embedder_cache[key] = _load_embedder(use_small)
     
     return _embedder_cache[key]
 
+def _load_embedder(use_small: bool) -> "SentenceTransformer":
+    """Load an embedding model and apply the configured CPU/GPU optimizations"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    
+    if not _embedder_cache:
+        # Some environments default torch to a single intra-op thread
+        torch.set_num_threads(os.cpu_count() or 1)
+    
+    model_name = EMBED_MODEL_SMALL if use_small else EMBED_MODEL
+    backend = os.getenv("EMBEDDER_BACKEND", "torch")
+    if backend == "onnx" and os.getenv("EMBEDDER_INT8", "1") == "1":
+        # The model repos ship pre-quantized int8 ONNX graphs; no export or quantize step at startup
+        try:
+            return SentenceTransformer(
+                model_name, backend=backend, model_kwargs={"file_name": EMBED_ONNX_INT8_FILE}
+            )
+        except Exception as e:
+            print(f"Warning: int8 ONNX model {EMBED_ONNX_INT8_FILE} unavailable, using fp32 ONNX: {e}")
+    
+    model = SentenceTransformer(model_name, backend=backend)
+    if backend != "torch":
+        # ONNX Runtime / OpenVINO run their own fused, optimized graphs; the torch tweaks below don't apply
+        return model
+    
+    model.eval()
+    
+    if model.device.type == "cuda":
+        # fp16 weights and activations: half the memory, tensor-core matmuls
+        model.half()
+    
+    if os.getenv("EMBEDDER_INT8", "1") == "1" and model.device.type == "cpu":
+        # Dynamic int8 quantization of the Linear layers (CPU only, ~2x encode throughput)
+        transformer = model[0]
+        transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+            transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif (
+        os.getenv("EMBEDDER_BF16") == "1"
+        and model.device.type == "cpu"
+        and torch.backends.mkldnn.is_available()
+        and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    ):
+        # bf16 weights for CPUs with native bf16 matmuls (AVX512-BF16 / AMX), when int8 is off;
+        # bf16 keeps fp32's exponent range, so it doesn't overflow the way fp16 can on CPU
+        model.to(torch.bfloat16)
+    
+    if os.getenv("EMBEDDER_COMPILE") == "1":
+        # Opt-in kernel fusion; dynamic shapes because chunk lengths vary. Compilation runs on
+        # the first forward pass, so warm up here rather than on a user's first request
+        transformer = model[0]
+        eager_model = transformer.auto_model
+        transformer.auto_model = torch.compile(eager_model, dynamic=True)
+        try:
+            _encode(model, ["warmup"] * 4)
+        except Exception as e:
+            print(f"Warning: torch.compile failed for the embedder, running eager: {e}")
+            transformer.auto_model = eager_model
+    
+    return model
+
 def split_into_sections(text: str) -> List[Dict[str, str]]:
     """Split clinical note into sections by recognizing headers"""
     if not text or text.strip() == "":
         return [{"section": "UNLABELED", "body": ""}]
     
-    pattern = "(" + "|".join(SECTION_HEADERS) + ")"
-    parts = re.split(pattern, text, flags=re.IGNORECASE)
+    parts = SECTION_PATTERN.split(text)
     
     if len(parts) <= 1:
         return [{"section": "UNLABELED", "body": text.strip()}]
@@ -86,20 +239,48 @@ def chunk_text(text: str, max_chars: int = 1500) -> List[str]:
     if not text:
         return []
     
-    chunks = []
-    start = 0
-    n = len(text)
+    # Fixed-width slices; the text was stripped once above, so slices are kept as-is
+    return [text[start:start + max_chars] for start in range(0, len(text), max_chars)]
+
+def chunk_text_by_tokens(text: str, embedder: "SentenceTransformer") -> List[str]:
+    """
+    Token-aware chunker: windows of at most the embedder's max sequence length, so no chunk
+    is silently truncated at encode time. Tokenizes once and slices the original text at
+    token offsets (no decode round-trip, chunk text stays verbatim for evidence highlighting)
+    """
+    text = text.strip()
+    if not text:
+        return []
     
-    while start < n:
-        end = min(start + max_chars, n)
-        chunk = text[start:end].strip()
-        chunks.append(chunk)
-        start = end
+    window = embedder.max_seq_length - 2  # room for the [CLS]/[SEP] special tokens
+    offsets = embedder.tokenizer(
+        text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+    )["offset_mapping"]
+    if len(offsets) <= window:
+        return [text]
     
-    return chunks
+    bounds = [0] + [offsets[i][0] for i in range(window, len(offsets), window)] + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
 
-def prepare_chunks_from_text(full_text: str, doc_id: int = 0) -> List[Dict[str, Any]]:
-    """Section-aware hierarchical chunking"""
+def prepare_chunks_from_text(
+    full_text: str,
+    doc_id: int = 0,
+    embedder: Optional["SentenceTransformer"] = None
+) -> List[Dict[str, Any]]:
+    """
+    Section-aware hierarchical chunking
+    With an embedder, sections are split into token windows that fit the model;
+    without one (short notes that skip retrieval), a character chunker is used
+    """
+    # Memoized on the note text; callers get their own dicts so cached entries can't be mutated
+    return [dict(c) for c in _prepare_chunks_cached(full_text, doc_id, embedder)]
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def _prepare_chunks_cached(
+    full_text: str,
+    doc_id: int,
+    embedder: Optional["SentenceTransformer"]
+) -> Tuple[Dict[str, Any], ...]:
     sections = split_into_sections(full_text)
     chunks = []
     chunk_seq = 0
@@ -107,10 +288,14 @@ def prepare_chunks_from_text(full_text: str, doc_id: int = 0) -> List[Dict[str,
     for sec in sections:
         header = sec["section"] if sec["section"] else "UNLABELED"
         body = sec["body"] if sec["body"] else ""
-        sec_chunks = chunk_text(body, max_chars=1500)
+        if embedder is not None:
+            sec_chunks = chunk_text_by_tokens(body, embedder)
+        else:
+            sec_chunks = chunk_text(body, max_chars=1500)
         
         for i, c in enumerate(sec_chunks):
-            chunk_id = f"{doc_id}_{header[:20]}_{chunk_seq}_{str(uuid.uuid4())[:8]}"
+            # Deterministic and sortable; short ids also save prompt tokens wherever they're cited
+            chunk_id = f"{doc_id}_{header[:12]}_{chunk_seq:04d}"
             chunks.append({
                 "chunk_id": chunk_id,
                 "text": c,
@@ -122,53 +307,316 @@ def prepare_chunks_from_text(full_text: str, doc_id: int = 0) -> List[Dict[str,
     
     if not chunks:
         chunks.append({
-            "chunk_id": f"{doc_id}_UNLABELED_0",
+            "chunk_id": f"{doc_id}_UNLABELED_0000",
             "text": full_text,
             "section": "UNLABELED",
             "doc_id": doc_id,
             "chunk_num": 0
         })
     
-    return chunks
+    return tuple(chunks)
 
-def build_index_from_chunks(
-    chunks: List[Dict[str, Any]], 
-    embedder: SentenceTransformer
-) -> Tuple[Any, Dict[int, Dict], np.ndarray]:
-    """Build FAISS index from chunks"""
-    texts = [c["text"] for c in chunks]
-    embeddings = embedder.encode(texts, show_progress_bar=False, convert_to_numpy=True)
+def _encode(embedder: "SentenceTransformer", texts: List[str]) -> np.ndarray:
+    import torch
+    
+    with torch.inference_mode():
+        embeddings = embedder.encode(
+            texts,
+            batch_size=EMBED_BATCH_SIZE_GPU if embedder.device.type == "cuda" else EMBED_BATCH_SIZE,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+    # fp16 (CUDA) / bf16 (CPU) models return half-precision arrays; FAISS and the matmul search expect
+    # C-contiguous float32 (a no-op, no copy, when encode already returned that)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+class _EncodeBatcher:
+    """
+    Coalesces concurrent embed_texts calls for one embedder into shared encode() calls.
+    The worker never waits for a batch to fill: it takes whatever is queued, so a lone
+    request pays no added latency, and requests arriving during an encode share the next one.
+    """
+    
+    def __init__(self, embedder: "SentenceTransformer"):
+        self.embedder = embedder
+        self.requests: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        threading.Thread(target=self._run, name="encode-batcher", daemon=True).start()
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        future: Future = Future()
+        self.requests.put((texts, future))
+        return future.result()
+    
+    def _run(self) -> None:
+        while True:
+            batch = [self.requests.get()]
+            while True:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = _encode(self.embedder, [text for texts, _ in batch for text in texts])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            if len(batch) == 1:
+                batch[0][1].set_result(embeddings)
+                continue
+            offset = 0
+            for texts, future in batch:
+                # Copy, so a cached index doesn't pin the other requests' rows in memory
+                future.set_result(embeddings[offset:offset + len(texts)].copy())
+                offset += len(texts)
+
+_batchers: Dict[int, _EncodeBatcher] = {}
+_batchers_lock = threading.Lock()
+
+def embed_texts(embedder: "SentenceTransformer", texts: List[str]) -> np.ndarray:
+    """Encode texts to L2-normalized float32 embeddings (normalized inside encode, no extra pass)"""
+    with _batchers_lock:
+        if id(embedder) not in _batchers:
+            _batchers[id(embedder)] = _EncodeBatcher(embedder)
+        batcher = _batchers[id(embedder)]
+    return batcher.encode(texts)
+
+def warmup() -> None:
+    """
+    Load the default embedder and run one encode (first-call kernel setup, batcher thread), and
+    create the Groq client if a key is configured, so the first user request doesn't pay for them
+    """
+    try:
+        embed_texts(get_embedder(), ["warmup"])
+        if os.getenv("GROQ_API_KEY"):
+            _groq_client(os.getenv("GROQ_API_KEY"))
+    except Exception as e:
+        print(f"Warning: warmup failed, models will load on first request: {e}")
+
+def _embed_unique(embedder: "SentenceTransformer", texts: List[str]) -> np.ndarray:
+    """Embed texts, encoding each distinct text once (notes repeat boilerplate like "No acute findings")"""
+    row_of: Dict[str, int] = {}
+    rows = [row_of.setdefault(text, len(row_of)) for text in texts]
+    if len(row_of) == len(texts):
+        return embed_texts(embedder, texts)
+    # Dicts keep insertion order, so list(row_of)[i] is the text for row i
+    return embed_texts(embedder, list(row_of))[rows]
+
+def _index_from_embeddings(embeddings: np.ndarray) -> Any:
+    """
+    Build the search index for normalized embeddings.
+    Small corpora (a single note) use the embedding matrix itself as the index and are
+    searched with one BLAS matmul; FAISS is only worth its overhead for large corpora.
+    """
+    if len(embeddings) < FAISS_MIN_CHUNKS:
+        return embeddings
+    
+    import faiss
     
     dim = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    faiss.normalize_L2(embeddings)
+    if len(embeddings) < FAISS_HNSW_MIN_CHUNKS:
+        # fp16 storage halves index memory and the bytes scanned per query; scores are
+        # still accumulated in fp32, so ranking of normalized vectors is unaffected
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # Approximate search (recall tuned per query through efSearch in retrieve_from_index);
+        # at this size memory dominates, so vectors are stored as 8-bit codes (4x smaller than fp32)
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings)
     index.add(embeddings)
+    return index
+
+def _note_embedding(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Whole-note embedding = renormalized mean of the chunk embeddings: no extra forward pass,
+    and unlike encoding the full text it isn't silently truncated at the model's max length
+    """
+    centroid = embeddings.mean(axis=0, keepdims=True)
+    centroid /= np.linalg.norm(centroid, axis=1, keepdims=True)
+    return centroid
+
+def _cached_index(cache_key: Tuple[int, str]) -> Optional[Tuple[Any, np.ndarray]]:
+    with _index_cache_lock:
+        entry = _index_cache.get(cache_key)
+        if entry is not None:
+            _index_cache.move_to_end(cache_key)
+        return entry
+
+def _cache_index(cache_key: Tuple[int, str], index: Any, note_embedding: np.ndarray) -> None:
+    with _index_cache_lock:
+        _index_cache[cache_key] = (index, note_embedding)
+        if len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+
+def _persisted_index_base(cache_key: Tuple[int, str], embedder: "SentenceTransformer") -> str:
+    # id(embedder) isn't stable across restarts, so files are named by the embedder's cache slot
+    # plus the runtime settings that change its vectors (backend, quantization, ONNX graph, device)
+    with _embedder_lock:
+        model_key = next(key for key, model in _embedder_cache.items() if model is embedder)
+    settings = json.dumps([
+        os.getenv("EMBEDDER_BACKEND", "torch"),
+        os.getenv("EMBEDDER_INT8", "1"),
+        os.getenv("EMBEDDER_BF16"),
+        EMBED_ONNX_INT8_FILE,
+        str(embedder.device)
+    ])
+    settings_key = hashlib.sha1(settings.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(INDEX_CACHE_DIR, f"{model_key}_{settings_key}_{cache_key[1]}")
+
+def _load_persisted_index(base: str) -> Optional[Tuple[Any, np.ndarray]]:
+    """Memory-map a persisted (index, note embedding) pair; None if it was never written"""
+    # The centroid is written last, so its presence marks a complete entry
+    if not os.path.exists(base + ".centroid.npy"):
+        return None
+    
+    if os.path.exists(base + ".faiss"):
+        import faiss
+        
+        index = faiss.read_index(base + ".faiss", faiss.IO_FLAG_MMAP)
+    else:
+        index = np.load(base + ".npy", mmap_mode="r")
+    return index, np.load(base + ".centroid.npy")
+
+def _persist_index(base: str, index: Any, note_embedding: np.ndarray) -> None:
+    """Write an (index, note embedding) pair; each file is renamed into place so readers never see partial writes"""
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    
+    if isinstance(index, np.ndarray):
+        with open(base + ".npy.tmp", "wb") as f:
+            np.save(f, index)
+        os.replace(base + ".npy.tmp", base + ".npy")
+    else:
+        import faiss
+        
+        faiss.write_index(index, base + ".faiss.tmp")
+        os.replace(base + ".faiss.tmp", base + ".faiss")
+    
+    with open(base + ".centroid.npy.tmp", "wb") as f:
+        np.save(f, note_embedding)
+    os.replace(base + ".centroid.npy.tmp", base + ".centroid.npy")
+
+def _index_cache_key(texts: List[str], embedder: "SentenceTransformer") -> Tuple[int, str]:
+    # Embedders live for the whole process in _embedder_cache, so id() is a stable key
+    digest = hashlib.sha1("\x00".join(texts).encode("utf-8")).hexdigest()
+    return (id(embedder), digest)
+
+def build_index_from_chunks(
+    chunks: List[Dict[str, Any]], 
+    embedder: "SentenceTransformer"
+) -> Tuple[Any, List[Dict[str, Any]], np.ndarray]:
+    """
+    Build FAISS index from chunks, reusing the cached index for identical chunk texts.
+    Row i of the index is chunks[i], so the chunk list itself is returned as the id map.
+    Also returns the normalized whole-note embedding (1, dim) for note-level queries
+    """
+    texts = [c["text"] for c in chunks]
+    cache_key = _index_cache_key(texts, embedder)
     
-    id_map = {i: chunks[i] for i in range(len(chunks))}
+    cached = _cached_index(cache_key)
+    if cached is not None:
+        index, note_embedding = cached
+    else:
+        base = _persisted_index_base(cache_key, embedder) if INDEX_CACHE_DIR else None
+        persisted = _load_persisted_index(base) if base else None
+        if persisted is not None:
+            index, note_embedding = persisted
+        else:
+            embeddings = _embed_unique(embedder, texts)
+            index = _index_from_embeddings(embeddings)
+            note_embedding = _note_embedding(embeddings)
+            if base:
+                _persist_index(base, index, note_embedding)
+        # Only the index and the (1, dim) centroid are kept; a FAISS index holds its own
+        # copy of the vectors, so the fp32 matrix is not retained alongside it
+        _cache_index(cache_key, index, note_embedding)
     
-    return index, id_map, embeddings
+    # The caller's own chunks, not cached ones: section labels aren't part of the cache key
+    return index, chunks, note_embedding
 
 def retrieve_from_index(
     query: str,
-    embedder: SentenceTransformer,
+    embedder: "SentenceTransformer",
     index: Any,
-    id_map: Dict[int, Dict],
-    top_k: int = 6
+    id_map: List[Dict[str, Any]],
+    top_k: int = 6,
+    query_embedding: Optional[np.ndarray] = None
 ) -> List[Dict[str, Any]]:
-    """Retrieve top-k relevant chunks"""
-    q_emb = embedder.encode([query], convert_to_numpy=True)
-    faiss.normalize_L2(q_emb)
-    D, I = index.search(q_emb, top_k)
-    
-    results = []
-    for idx, score in zip(I[0], D[0]):
-        if idx < 0:
+    """Retrieve top-k relevant chunks (query_embedding, if given, must already be normalized)"""
+    if query_embedding is not None:
+        # Precomputed (possibly disk-cached) embeddings go to FAISS as-is, so enforce its layout here
+        q_emb = np.ascontiguousarray(query_embedding, dtype=np.float32)
+    else:
+        q_emb = embed_texts(embedder, [query])
+    if isinstance(index, np.ndarray):
+        scores = index @ q_emb[0]
+        if top_k < len(scores):
+            # O(N) partition to the top-k, then sort only those k
+            top = np.argpartition(-scores, top_k)[:top_k]
+            top = top[np.argsort(-scores[top])]
+        else:
+            top = np.argsort(-scores)
+        D, I = scores[top][None, :], top[None, :]
+    elif hasattr(index, "hnsw"):
+        import faiss
+        
+        # Per-call search params rather than mutating index.hnsw, so cached indexes stay thread-safe
+        params = faiss.SearchParametersHNSW(efSearch=max(top_k * 4, 32))
+        D, I = index.search(q_emb, top_k, params=params)
+    else:
+        D, I = index.search(q_emb, top_k)
+    
+    # Index rows line up with id_map positions, so each hit is a plain list lookup
+    return [
+        {**id_map[idx], "score": score}
+        for idx, score in zip(I[0].tolist(), D[0].tolist())
+        if idx >= 0
+    ]
+
+def parse_ddx_json(raw: str) -> Any:
+    """Parse the DDx JSON, repairing common LLM formatting slips before giving up"""
+    text = raw.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        first_error = e
+    
+    # Strip ```json fences and any prose around the outermost array/object
+    cleaned = CODE_FENCE_RE.sub("", text).strip()
+    starts = [i for i in (cleaned.find("["), cleaned.find("{")) if i != -1]
+    if starts:
+        start = min(starts)
+        end = cleaned.rfind("]" if cleaned[start] == "[" else "}")
+        if end > start:
+            cleaned = cleaned[start:end + 1]
+    
+    without_trailing_commas = TRAILING_COMMA_RE.sub(lambda m: m.group(1) or m.group(0), cleaned)
+    for candidate in (cleaned, without_trailing_commas):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
             continue
-        item = id_map[idx].copy()
-        item["score"] = float(score)
-        results.append(item)
     
-    return results
+    raise first_error
+
+def _is_ddx_item(item: Any) -> bool:
+    return isinstance(item, dict) and "diagnosis" in item and "confidence" in item
+
+def _is_fused_analysis(fused: Any) -> bool:
+    """Check a parsed fused response against FUSED_ANALYSIS_JSON_SCHEMA's shape (JSON mode only guarantees valid JSON)"""
+    return (
+        isinstance(fused, dict)
+        and isinstance(fused.get("extraction"), str)
+        and isinstance(fused.get("soap"), str)
+        and isinstance(fused.get("ddx"), list)
+        and len(fused["ddx"]) > 0
+        and all(_is_ddx_item(item) for item in fused["ddx"])
+    )
+
+class LLMOutputValidationError(Exception):
+    """The provider rejected its own generation as not matching the requested JSON format"""
 
 # LLM functions
 def call_colab_t4(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> str:
@@ -181,7 +629,7 @@ def call_colab_t4(system_prompt: str, user_prompt: str, max_tokens: int = 512, t
         }
         headers = {"Content-Type": "application/json"}
         # Use a short timeout for connection but longer for read if needed
-        response = requests.post(COLAB_T4_URL, json=payload, headers=headers, timeout=120)
+        response = _http_session.post(COLAB_T4_URL, json=payload, headers=headers, timeout=120)
         response.raise_for_status()
         
         # Determine if response is json or text
@@ -202,26 +650,20 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
     """Local stub for offline demo"""
     lowered = user_prompt.lower()
     
-    def extract_chunk_ids(text, keyword):
-        chunks = []
-        lines = text.split('\n')
-        for line in lines:
-            if keyword in line.lower() and '[' in line and ']' in line:
-                try:
-                    start = line.find('[')
-                    end = line.find(']', start)
-                    if start != -1 and end != -1:
-                        chunk_id = line[start+1:end]
-                        if chunk_id and not chunk_id.startswith('evidence') and '_' in chunk_id:
-                            chunks.append(chunk_id)
-                except:
-                    pass
-        return chunks[:2]
+    # Index the chunk-tagged lines once; keyword lookups then scan only those lines
+    chunk_lines = [
+        (m.group(0).lower(), m.group(1))
+        for m in CHUNK_LINE_RE.finditer(user_prompt)
+        if m.group(1) and not m.group(1).startswith('evidence') and '_' in m.group(1)
+    ]
+    
+    def extract_chunk_ids(keyword):
+        return [chunk_id for line, chunk_id in chunk_lines if keyword in line][:2]
     
     
     # Step 3: Interactive Chat (Moved to top)
     if "user question" in lowered or "chat history" in lowered:
-        question_match = re.search(r'USER QUESTION: (.*)', user_prompt, re.IGNORECASE)
+        question_match = QUESTION_RE.search(user_prompt)
         question = question_match.group(1) if question_match else "your question"
         
         # Simple keyword matching for demo
@@ -229,9 +671,9 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         response_parts.append(f"Based on the analysis regarding \"{question}\":\n")
         
         # Check context for relevant info
-        context_match = re.search(r'CONTEXT:\n(.*?)CHAT HISTORY', user_prompt, re.DOTALL)
+        context_match = CONTEXT_BEFORE_HISTORY_RE.search(user_prompt)
         if not context_match:
-             context_match = re.search(r'CONTEXT:\n(.*?)USER QUESTION', user_prompt, re.DOTALL)
+             context_match = CONTEXT_BEFORE_QUESTION_RE.search(user_prompt)
              
         context = context_match.group(1) if context_match else ""
         
@@ -251,35 +693,38 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         response_parts.append("\n(Note: This is a local demo stub. For full reasoning, switch to Ollama or OpenAI mode.)")
         return "\n".join(response_parts)
 
+    # Scan the prompt once per keyword; the branches below then do set lookups
+    hits = {keyword for keyword in STUB_KEYWORDS if keyword in lowered}
+    
     # Step 2: Differential Diagnosis
     if (("differential diagnoses" in lowered or "json array" in lowered or 
         "step1_output" in lowered or "reasoning engine" in system_prompt.lower()) and 
         "user question" not in lowered):
         
-        has_fever = any(word in lowered for word in ["fever", "febrile", "temperature"])
-        has_chest_pain = any(word in lowered for word in ["chest pain", "chest discomfort"])
-        has_sob = any(word in lowered for word in ["shortness of breath", "dyspnea", "sob"])
-        has_cough = "cough" in lowered
-        has_headache = "headache" in lowered
-        has_neck = any(word in lowered for word in ["neck stiffness", "nuchal"])
-        has_meningeal = any(word in lowered for word in ["meningeal", "kernig", "brudzinski"])
-        has_abd_pain = any(word in lowered for word in ["abdominal pain", "belly pain", "stomach pain"])
-        has_nausea = any(word in lowered for word in ["nausea", "vomiting"])
-        has_confusion = any(word in lowered for word in ["confusion", "altered", "disoriented"])
-        has_elevated_wbc = "wbc" in lowered or "white blood" in lowered
-        has_troponin = "troponin" in lowered
+        has_fever = any(word in hits for word in ["fever", "febrile", "temperature"])
+        has_chest_pain = any(word in hits for word in ["chest pain", "chest discomfort"])
+        has_sob = any(word in hits for word in ["shortness of breath", "dyspnea", "sob"])
+        has_cough = "cough" in hits
+        has_headache = "headache" in hits
+        has_neck = any(word in hits for word in ["neck stiffness", "nuchal"])
+        has_meningeal = any(word in hits for word in ["meningeal", "kernig", "brudzinski"])
+        has_abd_pain = any(word in hits for word in ["abdominal pain", "belly pain", "stomach pain"])
+        has_nausea = any(word in hits for word in ["nausea", "vomiting"])
+        has_confusion = any(word in hits for word in ["confusion", "altered", "disoriented"])
+        has_elevated_wbc = "wbc" in hits or "white blood" in hits
+        has_troponin = "troponin" in hits
         
         # Heart failure indicators
-        has_orthopnea = "orthopnea" in lowered
-        has_edema = any(word in lowered for word in ["edema", "swelling", "leg swelling"])
-        has_jvd = any(word in lowered for word in ["jugular", "jvp", "jvd"])
-        has_crackles = any(word in lowered for word in ["crackles", "rales"])
-        has_bnp = "bnp" in lowered
-        has_cardiomegaly = "cardiomegaly" in lowered
-        has_pulm_congestion = any(word in lowered for word in ["pulmonary congestion", "pulmonary edema"])
-        has_hypertension = any(word in lowered for word in ["hypertension", "blood pressure"])
-        has_ckd = any(word in lowered for word in ["chronic kidney", "ckd", "renal"])
-        has_diabetes = any(word in lowered for word in ["diabetes", "dm", "diabetic"])
+        has_orthopnea = "orthopnea" in hits
+        has_edema = any(word in hits for word in ["edema", "swelling", "leg swelling"])
+        has_jvd = any(word in hits for word in ["jugular", "jvp", "jvd"])
+        has_crackles = any(word in hits for word in ["crackles", "rales"])
+        has_bnp = "bnp" in hits
+        has_cardiomegaly = "cardiomegaly" in hits
+        has_pulm_congestion = any(word in hits for word in ["pulmonary congestion", "pulmonary edema"])
+        has_hypertension = any(word in hits for word in ["hypertension", "blood pressure"])
+        has_ckd = any(word in hits for word in ["chronic kidney", "ckd", "renal"])
+        has_diabetes = any(word in hits for word in ["diabetes", "dm", "diabetic"])
         
         ddx = []
         
@@ -287,7 +732,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if (has_sob and has_orthopnea and has_edema) or (has_jvd and has_crackles) or has_bnp:
             evidence_chunks = []
             for keyword in ["shortness", "orthopnea", "edema", "swelling", "jugular", "crackles", "bnp", "cardiomegaly"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -302,7 +747,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if has_hypertension and (has_sob or has_headache or has_confusion):
             evidence_chunks = []
             for keyword in ["blood pressure", "hypertension"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -317,7 +762,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if has_ckd and has_edema and has_sob:
             evidence_chunks = []
             for keyword in ["kidney", "renal", "edema", "fluid"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -332,7 +777,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if (has_fever and has_neck and has_headache) or has_meningeal:
             evidence_chunks = []
             for keyword in ["fever", "neck", "nuchal", "headache", "meningeal"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -346,7 +791,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if has_fever and (has_cough or has_sob) and has_elevated_wbc:
             evidence_chunks = []
             for keyword in ["fever", "cough", "breath", "wbc"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -360,7 +805,7 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         if has_chest_pain and (has_troponin or has_sob):
             evidence_chunks = []
             for keyword in ["chest", "pain", "troponin"]:
-                chunks = extract_chunk_ids(user_prompt, keyword)
+                chunks = extract_chunk_ids(keyword)
                 evidence_chunks.extend(chunks)
             evidence_chunks = list(set(evidence_chunks))[:3]
             
@@ -389,44 +834,44 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         plan = []
         
         # Subjective findings
-        if "fever" in lowered:
+        if "fever" in hits:
             subjective.append("fever")
-        if "headache" in lowered:
+        if "headache" in hits:
             subjective.append("severe headache")
-        if "neck stiffness" in lowered or "nuchal rigidity" in lowered:
+        if "neck stiffness" in hits or "nuchal rigidity" in hits:
             subjective.append("neck stiffness")
-        if "shortness of breath" in lowered or "dyspnea" in lowered or "sob" in lowered:
+        if "shortness of breath" in hits or "dyspnea" in hits or "sob" in hits:
             subjective.append("progressive shortness of breath")
-        if "orthopnea" in lowered:
+        if "orthopnea" in hits:
             subjective.append("orthopnea")
-        if "leg swelling" in lowered or "edema" in lowered:
+        if "leg swelling" in hits or "edema" in hits:
             subjective.append("bilateral leg swelling")
         
         # Objective findings
-        if "temp" in lowered or "fever" in lowered:
+        if "temp" in hits or "fever" in hits:
             objective.append("elevated temperature")
-        if "nuchal rigidity" in lowered:
+        if "nuchal rigidity" in hits:
             objective.append("positive meningeal signs")
-        if "wbc" in lowered:
+        if "wbc" in hits:
             objective.append("elevated WBC")
-        if "jugular" in lowered or "jvp" in lowered:
+        if "jugular" in hits or "jvp" in hits:
             objective.append("elevated JVP")
-        if "crackles" in lowered or "rales" in lowered:
+        if "crackles" in hits or "rales" in hits:
             objective.append("bilateral basal crackles")
-        if "edema" in lowered or "pitting" in lowered:
+        if "edema" in hits or "pitting" in hits:
             objective.append("pitting edema")
-        if "blood pressure" in lowered or "bp" in lowered:
-            if "168" in lowered or "hypertension" in lowered:
+        if "blood pressure" in hits or "bp" in hits:
+            if "168" in hits or "hypertension" in hits:
                 objective.append("BP 168/92 mmHg")
-        if "bnp" in lowered:
+        if "bnp" in hits:
             objective.append("BNP 980 pg/mL")
-        if "cardiomegaly" in lowered or "pulmonary congestion" in lowered:
+        if "cardiomegaly" in hits or "pulmonary congestion" in hits:
             objective.append("cardiomegaly and pulmonary congestion on CXR")
         
         # Assessment
-        if ("shortness of breath" in lowered or "dyspnea" in lowered) and ("edema" in lowered or "orthopnea" in lowered):
+        if ("shortness of breath" in hits or "dyspnea" in hits) and ("edema" in hits or "orthopnea" in hits):
             assessment.append("Acute decompensated heart failure")
-        elif "meningitis" in lowered:
+        elif "meningitis" in hits:
             assessment.append("Concerning for bacterial meningitis")
         
         s_text = ", ".join(subjective) if subjective else "Patient presents with acute symptoms"
@@ -442,13 +887,14 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         
         # Demographics
         demographics = []
-        age_match = re.search(r'(\d+)[- ]year[s]?[- ]old', lowered)
+        age_match = AGE_RE.search(lowered)
         if age_match:
             demographics.append(f"- Age: {age_match.group(1)} years")
         
-        if re.search(r'\bmale\b', lowered) and not re.search(r'\bfemale\b', lowered):
+        has_female = FEMALE_RE.search(lowered) is not None
+        if MALE_RE.search(lowered) and not has_female:
             demographics.append("- Sex: Male")
-        elif re.search(r'\bfemale\b', lowered):
+        elif has_female:
             demographics.append("- Sex: Female")
         
         if not demographics:
@@ -469,8 +915,8 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         
         for symptom_name, keywords in symptom_keywords.items():
             for keyword in keywords:
-                if keyword in lowered:
-                    chunks = extract_chunk_ids(user_prompt, keyword)
+                if keyword in hits:
+                    chunks = extract_chunk_ids(keyword)
                     symptoms.append(f"- {symptom_name.title()} [evidence: {chunks[0] if chunks else 'CLINICAL'}]")
                     break
         
@@ -480,13 +926,13 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
         
         # Physical Exam & Vitals
         exam = ["- Vital signs and physical examination documented"]
-        if "nuchal rigidity" in lowered or "meningeal" in lowered:
+        if "nuchal rigidity" in hits or "meningeal" in hits:
             exam = ["- Positive meningeal signs noted [evidence: PHYSICAL]"]
         out.append("3. Physical Exam & Vitals:\n" + "\n".join(exam))
         
         # Labs
         labs = []
-        if "wbc" in lowered or "white blood cell" in lowered:
+        if "wbc" in hits or "white blood cell" in hits:
             labs.append("- Elevated WBC [evidence: LABS]")
         if not labs:
             labs = ["- Laboratory results available"]
@@ -502,64 +948,165 @@ def call_local_stub(system_prompt: str, user_prompt: str, max_tokens: int = 512,
     return "LOCAL_STUB_RESPONSE"
 
 
-def call_ollama(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> str:
+OLLAMA_URL = "http://127.0.0.1:11434/api/generate"  # 127.0.0.1 instead of localhost avoids IPv6 resolution issues
+# Model tag; pick a quantized tag (e.g. llama3.2:3b-instruct-q8_0) to trade accuracy for speed
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
+# How long Ollama keeps the model loaded after a request (its default of 5m means an idle
+# demo pays a full model reload on the next analysis)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+
+def _ollama_payload(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    json_schema: Optional[Dict[str, Any]],
+    stream: bool
+) -> Dict[str, Any]:
+    # Combine system and user prompts for Ollama
+    full_prompt = f"{system_prompt}\n\n{user_prompt}"
+    
+    payload = {
+        "model": OLLAMA_MODEL,
+        "prompt": full_prompt,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "temperature": temperature,
+            "num_predict": max_tokens
+        }
+    }
+    if json_schema is not None:
+        payload["format"] = json_schema
+    return payload
+
+
+def _ollama_error_message(e: Exception) -> str:
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return "ERROR: Ollama is not running. Please start Ollama with 'ollama serve' and ensure you have a model installed (e.g., 'ollama pull llama3.2:3b')"
+    if isinstance(e, requests.exceptions.Timeout):
+        return "ERROR: Ollama request timed out. The first request can take significantly longer (up to 5 mins) as the model loads into RAM. Please try again - subsequent requests will be faster!"
+    if isinstance(e, requests.exceptions.HTTPError):
+        return f"ERROR: Ollama HTTP error: {str(e)}. Make sure Llama 3.2 model is installed with 'ollama pull llama3.2:3b'"
+    return f"ERROR calling Ollama: {str(e)}"
+
+
+def call_ollama(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    json_schema: Optional[Dict[str, Any]] = None
+) -> str:
     """
     Call Ollama (local LLM) API
     Requires Ollama to be running locally (ollama serve)
     Install: https://ollama.com/download
     Run: ollama pull mistral (or llama2, phi, etc.)
-    """
-    import requests
     
+    If json_schema is given, Ollama constrains decoding to match it (structured outputs)
+    """
     try:
-        # Use 127.0.0.1 instead of localhost to avoid IPv6 resolution issues
-        url = "http://127.0.0.1:11434/api/generate"
-        
-        # Combine system and user prompts for Ollama
-        full_prompt = f"{system_prompt}\n\n{user_prompt}"
-        
-        payload = {
-            "model": "llama3.2:3b",  # Can be changed to llama2, phi, etc.
-            "prompt": full_prompt,
-            "stream": False,
-            "options": {
-                "temperature": temperature,
-                "num_predict": max_tokens
-            }
-        }
+        payload = _ollama_payload(system_prompt, user_prompt, max_tokens, temperature, json_schema, stream=False)
         
-        response = requests.post(url, json=payload, timeout=300)
+        response = _http_session.post(OLLAMA_URL, json=payload, timeout=300)
         response.raise_for_status()
         
         result = response.json()
         return result.get("response", "No response from Ollama")
         
-    except requests.exceptions.ConnectionError:
-        return "ERROR: Ollama is not running. Please start Ollama with 'ollama serve' and ensure you have a model installed (e.g., 'ollama pull llama3.2:3b')"
-    except requests.exceptions.Timeout:
-        return "ERROR: Ollama request timed out. The first request can take significantly longer (up to 5 mins) as the model loads into RAM. Please try again - subsequent requests will be faster!"
-    except requests.exceptions.HTTPError as e:
-        return f"ERROR: Ollama HTTP error: {str(e)}. Make sure Llama 3.2 model is installed with 'ollama pull llama3.2:3b'"
     except Exception as e:
-        return f"ERROR calling Ollama: {str(e)}"
+        return _ollama_error_message(e)
+
+
+def call_ollama_stream(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    json_schema: Optional[Dict[str, Any]] = None
+) -> Generator[str, None, bool]:
+    """
+    Streaming variant of call_ollama: yields response text as Ollama generates it
+    Returns True only if Ollama finished the response ("done"); on failure the error
+    message is yielded as the last delta and False is returned
+    """
+    try:
+        payload = _ollama_payload(system_prompt, user_prompt, max_tokens, temperature, json_schema, stream=True)
+        
+        with _http_session.post(OLLAMA_URL, json=payload, stream=True, timeout=300) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                part = json.loads(line)
+                if part.get("error"):
+                    yield f"ERROR calling Ollama: {part['error']}"
+                    return False
+                if part.get("response"):
+                    yield part["response"]
+                if part.get("done"):
+                    return True
+        
+        yield "ERROR calling Ollama: stream ended before the response was complete"
+        return False
+                    
+    except Exception as e:
+        yield _ollama_error_message(e)
+        return False
+
+
+_groq_clients: Dict[str, Any] = {}
+
+def _groq_json_mode(json_schema: Optional[Dict[str, Any]]) -> bool:
+    # Groq's JSON mode only emits objects, so array schemas fall back to plain prompting
+    return json_schema is not None and json_schema.get("type") == "object"
+
+def _is_groq_json_validation_error(e: Exception) -> bool:
+    # JSON mode answers a generation that isn't valid JSON with HTTP 400 json_validate_failed
+    body = getattr(e, "body", None)
+    error = body.get("error", body) if isinstance(body, dict) else None
+    if isinstance(error, dict):
+        return error.get("code") == "json_validate_failed" or "failed_generation" in error
+    return "json_validate_failed" in str(e)
 
+def _groq_client(api_key: str) -> Any:
+    """One Groq client per API key, so its httpx connection pool (and TLS sessions) is reused across calls"""
+    if api_key not in _groq_clients:
+        from groq import Groq
+        
+        _groq_clients[api_key] = Groq(api_key=api_key)
+    return _groq_clients[api_key]
 
-def call_groq(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> str:
+
+def call_groq(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    json_schema: Optional[Dict[str, Any]] = None
+) -> str:
     """
     Call Groq API (fast, free inference)
     Get free API key at: https://console.groq.com
     Set GROQ_API_KEY in .env file
+    If json_schema describes an object, Groq's JSON mode guarantees a parseable response; a
+    generation Groq rejects as invalid JSON raises LLMOutputValidationError rather than returning
+    error text, since it is a bad sample rather than a provider failure
     """
     import os
     
     try:
-        from groq import Groq
-        
         api_key = os.getenv("GROQ_API_KEY")
         if not api_key:
             return "ERROR: GROQ_API_KEY not found in environment. Get free key at https://console.groq.com"
         
-        client = Groq(api_key=api_key)
+        client = _groq_client(api_key)
+        
+        extra = {}
+        if _groq_json_mode(json_schema):
+            extra["response_format"] = {"type": "json_object"}
         
         response = client.chat.completions.create(
             model="llama-3.1-8b-instant",  # Fast, free model (updated from deprecated llama3-8b-8192)
@@ -568,7 +1115,8 @@ def call_groq(system_prompt: str, user_prompt: str, max_tokens: int = 512, tempe
                 {"role": "user", "content": user_prompt}
             ],
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            **extra
         )
         
         return response.choices[0].message.content
@@ -576,9 +1124,62 @@ def call_groq(system_prompt: str, user_prompt: str, max_tokens: int = 512, tempe
     except ImportError:
         return "ERROR: groq package not installed. Run: pip install groq"
     except Exception as e:
+        if _groq_json_mode(json_schema) and _is_groq_json_validation_error(e):
+            raise LLMOutputValidationError(str(e)) from e
         return f"ERROR calling Groq: {str(e)}"
 
 
+def call_groq_stream(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.7
+) -> Generator[str, None, bool]:
+    """
+    Streaming variant of call_groq: yields content deltas as Groq generates them
+    Returns True only if Groq reported a finish_reason; on failure the error message
+    is yielded as the last delta and False is returned
+    """
+    import os
+    
+    try:
+        api_key = os.getenv("GROQ_API_KEY")
+        if not api_key:
+            yield "ERROR: GROQ_API_KEY not found in environment. Get free key at https://console.groq.com"
+            return False
+        
+        client = _groq_client(api_key)
+        
+        stream = client.chat.completions.create(
+            model="llama-3.1-8b-instant",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        
+        finished = False
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finished = True
+        
+        if not finished:
+            yield "ERROR calling Groq: stream ended before the response was complete"
+        return finished
+        
+    except ImportError:
+        yield "ERROR: groq package not installed. Run: pip install groq"
+        return False
+    except Exception as e:
+        yield f"ERROR calling Groq: {str(e)}"
+        return False
+
+
 def call_gemini(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> str:
     """
     Call Google Gemini API (free tier available)
@@ -617,21 +1218,94 @@ def call_gemini(system_prompt: str, user_prompt: str, max_tokens: int = 512, tem
         return f"ERROR calling Gemini: {str(e)}"
 
 
-def call_llm(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.0, llm_mode: str = "local_stub") -> str:
+def _llm_cache_key(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    llm_mode: str,
+    json_schema: Optional[Dict[str, Any]]
+) -> Optional[str]:
+    # Exact-match only: a "similar" clinical note can differ in exactly the finding that matters,
+    # so semantic (embedding-similarity) caching isn't safe here. Sampled outputs aren't cached
+    if temperature != 0 or llm_mode == "local_stub":
+        return None
+    key = json.dumps(
+        [llm_mode, OLLAMA_MODEL if llm_mode == "ollama" else None, system_prompt, user_prompt, max_tokens, json_schema],
+        sort_keys=True
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def _is_llm_error(response: str) -> bool:
+    # Provider failures come back as text rather than exceptions
+    return response.startswith(("ERROR", "Error calling"))
+
+def _cached_llm_response(cache_key: Optional[str]) -> Optional[str]:
+    if cache_key is None:
+        return None
+    with _llm_cache_lock:
+        response = _llm_cache.get(cache_key)
+        if response is not None:
+            _llm_cache.move_to_end(cache_key)
+        return response
+
+def _store_llm_response(cache_key: str, response: str) -> None:
+    # Don't let a transient provider failure stick
+    if _is_llm_error(response):
+        return
+    with _llm_cache_lock:
+        _llm_cache[cache_key] = response
+        if len(_llm_cache) > LLM_CACHE_SIZE:
+            _llm_cache.popitem(last=False)
+
+
+def call_llm(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.0,
+    llm_mode: str = "local_stub",
+    json_schema: Optional[Dict[str, Any]] = None
+) -> str:
     """
     Call appropriate LLM based on mode
     
+    json_schema constrains the output server-side where the provider supports it
+    (currently Ollama); other modes still rely on the prompt and parse_ddx_json.
+    
     Supported modes:
     - local_stub: Fast demo mode (no API/setup needed)
     - ollama: Local LLM via Ollama (FREE, private, no API key)
     - groq: Fast API (FREE with generous limits)
     - gemini: Google AI (FREE tier available)
     - openai: OpenAI API (requires paid API key)
+    
+    Deterministic (temperature 0) responses are cached on the exact prompt, so re-analyzing
+    the same note skips the LLM round-trips
     """
+    cache_key = _llm_cache_key(system_prompt, user_prompt, max_tokens, temperature, llm_mode, json_schema)
+    cached = _cached_llm_response(cache_key)
+    if cached is not None:
+        return cached
+    
+    response = _dispatch_llm(system_prompt, user_prompt, max_tokens, temperature, llm_mode, json_schema)
+    if cache_key is not None:
+        _store_llm_response(cache_key, response)
+    return response
+
+
+def _dispatch_llm(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    llm_mode: str,
+    json_schema: Optional[Dict[str, Any]]
+) -> str:
     if llm_mode == "ollama":
-        return call_ollama(system_prompt, user_prompt, max_tokens, temperature)
+        return call_ollama(system_prompt, user_prompt, max_tokens, temperature, json_schema=json_schema)
     elif llm_mode == "groq":
-        return call_groq(system_prompt, user_prompt, max_tokens, temperature)
+        return call_groq(system_prompt, user_prompt, max_tokens, temperature, json_schema=json_schema)
     elif llm_mode == "gemini":
         return call_gemini(system_prompt, user_prompt, max_tokens, temperature)
     elif llm_mode == "colab_t4":
@@ -640,43 +1314,277 @@ def call_llm(system_prompt: str, user_prompt: str, max_tokens: int = 512, temper
         return call_local_stub(system_prompt, user_prompt, max_tokens, temperature)
 
 
-async def analyze_clinical_note(
+def _tee(stream: Generator[str, None, bool], parts: List[str]) -> Generator[str, None, bool]:
+    """Re-yield a stream's deltas, also collecting them into parts; returns the stream's return value"""
+    while True:
+        try:
+            delta = next(stream)
+        except StopIteration as stop:
+            return stop.value
+        parts.append(delta)
+        yield delta
+
+
+def stream_llm(
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.0,
+    llm_mode: str = "local_stub",
+    json_schema: Optional[Dict[str, Any]] = None
+) -> Generator[str, None, bool]:
+    """
+    Like call_llm, but yields the response incrementally
+    Ollama and Groq stream tokens as they are generated; other modes, Groq JSON-mode calls (which
+    Groq doesn't stream) and cache hits yield the full response once
+    Returns True if the response completed; on a provider failure the error message is the last delta
+    """
+    if llm_mode == "ollama" or (llm_mode == "groq" and not _groq_json_mode(json_schema)):
+        cache_key = _llm_cache_key(system_prompt, user_prompt, max_tokens, temperature, llm_mode, json_schema)
+        cached = _cached_llm_response(cache_key)
+        if cached is not None:
+            yield cached
+            return True
+        
+        if llm_mode == "ollama":
+            deltas = call_ollama_stream(system_prompt, user_prompt, max_tokens, temperature, json_schema=json_schema)
+        else:
+            deltas = call_groq_stream(system_prompt, user_prompt, max_tokens, temperature)
+        parts = []
+        completed = yield from _tee(deltas, parts)
+        # A failure mid-stream leaves partial text plus the error message; only cache clean completions
+        if completed and cache_key is not None:
+            _store_llm_response(cache_key, "".join(parts))
+        return completed
+    else:
+        response = call_llm(system_prompt, user_prompt, max_tokens, temperature, llm_mode=llm_mode, json_schema=json_schema)
+        yield response
+        return not _is_llm_error(response)
+
+
+def iter_json_object_fields(deltas: Iterable[str]) -> Iterator[Tuple[str, str, Any]]:
+    """
+    Incrementally parse a streamed JSON object, yielding its top-level fields as they arrive:
+    ("delta", key, text) for each newly decoded piece of a string value, ("item", key, item) for
+    each object in an array value as soon as its closing brace arrives, and ("value", key, value)
+    once a value is complete. Text before the opening brace (e.g. a ```json fence) is skipped;
+    pieces that fail to parse are dropped, since the caller re-parses the complete output anyway.
+    """
+    buf = []
+    depth = 0
+    in_string = False
+    escaped = False
+    unicode_left = 0  # hex digits still to come in a \uXXXX escape
+    state = "key"  # position inside the top-level object: key, value (after the colon) or in_value
+    key = None
+    key_start = None
+    value_start = None
+    string_from = None  # start of the not-yet-yielded part of a top-level string value
+    item_start = None
+    pos = 0
+    
+    def decode(start: int, end: int) -> Optional[str]:
+        try:
+            return json.loads('"' + "".join(buf[start:end]) + '"')
+        except json.JSONDecodeError:
+            return None
+    
+    def load(start: int, end: int) -> Any:
+        try:
+            return json.loads("".join(buf[start:end]))
+        except json.JSONDecodeError:
+            return None
+    
+    for delta in deltas:
+        for ch in delta:
+            buf.append(ch)
+            if in_string:
+                if unicode_left:
+                    unicode_left -= 1
+                elif escaped:
+                    escaped = False
+                    if ch == "u":
+                        unicode_left = 4
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                    if depth == 1 and key_start is not None:
+                        key = load(key_start, pos + 1)
+                        key_start = None
+                    elif depth == 1 and string_from is not None:
+                        rest = decode(string_from, pos)
+                        if rest:
+                            yield "delta", key, rest
+                        value = decode(value_start + 1, pos)
+                        if value is not None:
+                            yield "value", key, value
+                        value_start = string_from = None
+                        state = "key"
+            elif depth == 0:
+                if ch == "{":
+                    depth = 1
+                    state = "key"
+            elif depth == 1:
+                if state == "in_value" and ch in ",}":
+                    # End of a number / true / false / null
+                    value = load(value_start, pos)
+                    if value is not None:
+                        yield "value", key, value
+                    value_start = None
+                    state = "key"
+                if ch == "}":
+                    depth = 0
+                elif ch == ":":
+                    state = "value"
+                elif ch == '"':
+                    in_string = True
+                    if state == "key":
+                        key_start = pos
+                    elif state == "value":
+                        value_start, string_from = pos, pos + 1
+                        state = "in_value"
+                elif state == "value" and not ch.isspace():
+                    value_start = pos
+                    state = "in_value"
+                    if ch in "[{":
+                        depth = 2
+            else:
+                if ch == '"':
+                    in_string = True
+                elif ch in "[{":
+                    if depth == 2 and ch == "{" and buf[value_start] == "[":
+                        item_start = pos
+                    depth += 1
+                elif ch in "]}":
+                    depth -= 1
+                    if depth == 2 and item_start is not None:
+                        item = load(item_start, pos + 1)
+                        if item is not None:
+                            yield "item", key, item
+                        item_start = None
+                    elif depth == 1:
+                        value = load(value_start, pos + 1)
+                        if value is not None:
+                            yield "value", key, value
+                        value_start = None
+                        state = "key"
+            pos += 1
+        
+        # Yield the decoded part of a string value received so far, unless it ends mid-escape
+        if in_string and string_from is not None and not escaped and not unicode_left and pos > string_from:
+            piece = decode(string_from, pos)
+            end = pos
+            if piece and "\ud800" <= piece[-1] <= "\udbff":
+                # High half of a \uXXXX surrogate pair: hold its 6-char escape back for the low half
+                piece, end = piece[:-1], pos - 6
+            if piece:
+                yield "delta", key, piece
+                string_from = end
+
+
+def iter_json_array_items(deltas: Iterable[str]) -> Iterator[Any]:
+    """
+    Incrementally parse a streamed JSON array, yielding each top-level item
+    as soon as its closing brace arrives. Text before the opening bracket
+    (e.g. a ```json fence) is skipped; items that fail to parse are dropped,
+    since the caller re-parses the complete output anyway.
+    """
+    buf = []
+    depth = 0
+    in_string = False
+    escaped = False
+    item_start = None
+    in_array = False
+    pos = 0
+    
+    for delta in deltas:
+        for ch in delta:
+            buf.append(ch)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = depth > 0
+            elif ch in "[{":
+                if depth == 0:
+                    in_array = ch == "["
+                depth += 1
+                if depth == 2 and ch == "{" and in_array:
+                    item_start = pos
+            elif ch in "]}" and depth > 0:
+                depth -= 1
+                if depth == 1 and ch == "}" and item_start is not None:
+                    try:
+                        yield json.loads("".join(buf[item_start:pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    item_start = None
+            pos += 1
+
+
+async def stream_clinical_note_analysis(
     full_text: str,
     llm_mode: str = "local_stub",
     top_k: int = 6,
-    use_small_embedder: bool = False
-) -> Dict[str, Any]:
-    """Main RAG pipeline - analyze clinical note"""
+    use_small_embedder: bool = True
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Main RAG pipeline - analyze clinical note, yielding {"event", "data"} dicts as stages finish:
+    retrieved -> step1_facts / soap_delta... soap (interleaved) -> ddx_item (one per diagnosis) -> result
+    A "reset" event means the fused call's output was unusable and the stages are being re-run
+    separately, so anything received since "retrieved" should be discarded.
+    The final "result" event carries the complete analysis dict
+    """
     start_time = time.time()
     
-    # Get embedder
-    embedder = get_embedder(use_small=use_small_embedder)
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    
+    def emit(event: str, data: Any) -> None:
+        # Called from worker threads, so hand the event to the loop thread-safely
+        loop.call_soon_threadsafe(events.put_nowait, {"event": event, "data": data})
     
-    # Prepare chunks and build index
-    chunks = prepare_chunks_from_text(full_text)
-    index, id_map, embeddings = build_index_from_chunks(chunks, embedder)
+    if len(full_text) < SHORT_NOTE_CHARS:
+        # Short note: every chunk goes into the context, no embedding or search needed
+        chunks = prepare_chunks_from_text(full_text)
+        retrieved = [{**c, "score": 1.0} for c in chunks]
+    else:
+        def retrieve_long_note() -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+            # Get embedder, chunk to its token windows, build index and retrieve relevant chunks
+            embedder = get_embedder(use_small=use_small_embedder)
+            chunks = prepare_chunks_from_text(full_text, embedder=embedder)
+            index, id_map, q_emb = build_index_from_chunks(chunks, embedder)
+            retrieved = retrieve_from_index(full_text, embedder, index, id_map, top_k=top_k, query_embedding=q_emb)
+            return chunks, retrieved
+        
+        # Off the event loop, so concurrent requests' encodes can be batched together
+        chunks, retrieved = await asyncio.to_thread(retrieve_long_note)
     
-    # Retrieve relevant chunks
-    retrieved = retrieve_from_index(full_text, embedder, index, id_map, top_k=top_k)
+    yield {"event": "retrieved", "data": retrieved}
     
-    # Create context
-    context_parts = []
-    for r in retrieved:
-        context_parts.append(f"[{r['chunk_id']}][{r['section']}]: {r['text']}")
-    context = "\n\n".join(context_parts)
+    # Create context in a single join (no intermediate list of parts)
+    context = "\n\n".join(f"[{r['chunk_id']}][{r['section']}]: {r['text']}" for r in retrieved)
     
     # Step 1: Extract structured facts
     step1_system = "You are a clinical extractor. Extract and organize facts from the provided context into categories. Do not make diagnoses."
     step1_user = f"CONTEXT:\n{context}\n\nExtract into categories:\n1. Patient History & Demographics:\n2. Chief Complaint & Symptoms:\n3. Physical Exam & Vitals:\n4. Key Lab & Imaging Findings:\n5. Clinician's Stated Assessment:\n\nInclude chunk ids in brackets after each finding."
     
-    step1_output = call_llm(step1_system, step1_user, llm_mode=llm_mode)
+    # SOAP note
+    soap_system = "You are a professional medical summarization agent. Produce a concise, factual SOAP note using only the context given."
+    soap_user = f"CONTEXT:\n{context}\n\nProduce SOAP: S (Subjective), O (Objective), A (Assessment), P (Plan)."
     
-    # Step 2: Differential diagnosis (Enhanced prompt for detailed analysis)
-    step2_system = """You are an expert clinical reasoning engine and diagnostic specialist. 
+    def run_ddx(step1_output: str) -> str:
+        # Step 2: Differential diagnosis (Enhanced prompt for detailed analysis)
+        step2_system = """You are an expert clinical reasoning engine and diagnostic specialist. 
 Your task is to analyze the structured clinical facts and produce a comprehensive, evidence-based differential diagnosis.
 Be thorough in your clinical reasoning and provide actionable insights."""
-    
-    step2_user = f"""STEP1_OUTPUT (Extracted Clinical Facts):
+        
+        step2_user = f"""STEP1_OUTPUT (Extracted Clinical Facts):
 {step1_output}
 
 TASK: Generate a detailed differential diagnosis analysis.
@@ -698,38 +1606,164 @@ Consider:
 3. Common conditions that present similarly
 
 Return ONLY valid JSON array, no other text."""
+        
+        if llm_mode == "colab_t4":
+            step2_output = """[
+                {
+                    "diagnosis": "Differential Diagnosis (Skipped for T4)",
+                    "confidence": "Low",
+                    "rationale": "Complex reasoning step skipped for optimization on T4 instance as per configuration.",
+                    "evidence": [],
+                    "workup": "N/A",
+                    "red_flags": "N/A"
+                }
+            ]"""
+        else:
+            # Stream Step 2 and emit each diagnosis as soon as its JSON object is complete
+            parts = []
+            
+            def collect() -> Iterator[str]:
+                for delta in stream_llm(
+                    step2_system, step2_user, max_tokens=1024, llm_mode=llm_mode, json_schema=DDX_JSON_SCHEMA
+                ):
+                    parts.append(delta)
+                    yield delta
+            
+            for item in iter_json_array_items(collect()):
+                # Only diagnosis-shaped objects, so nothing shows up live that the final parse won't keep
+                if _is_ddx_item(item):
+                    emit("ddx_item", item)
+            step2_output = "".join(parts)
+        
+        return step2_output
     
-    if llm_mode == "colab_t4":
-        step2_output = """[
-            {
-                "diagnosis": "Differential Diagnosis (Skipped for T4)",
-                "confidence": "Low",
-                "rationale": "Complex reasoning step skipped for optimization on T4 instance as per configuration.",
-                "evidence": [],
-                "workup": "N/A",
-                "red_flags": "N/A"
-            }
-        ]"""
-    else:
-        step2_output = call_llm(step2_system, step2_user, max_tokens=1024, llm_mode=llm_mode)
+    def run_facts_and_ddx() -> Tuple[str, str]:
+        """Step 1 -> Step 2 chain; Step 2 needs Step 1's output, so these stay sequential"""
+        step1_output = call_llm(step1_system, step1_user, llm_mode=llm_mode)
+        emit("step1_facts", step1_output)
+        return step1_output, run_ddx(step1_output)
     
-    # SOAP note
-    soap_system = "You are a professional medical summarization agent. Produce a concise, factual SOAP note using only the context given."
-    soap_user = f"CONTEXT:\n{context}\n\nProduce SOAP: S (Subjective), O (Objective), A (Assessment), P (Plan)."
+    def run_soap() -> str:
+        # SOAP is the note the clinician reads first, so its tokens are streamed as they arrive
+        parts = []
+        for delta in stream_llm(soap_system, soap_user, llm_mode=llm_mode):
+            parts.append(delta)
+            emit("soap_delta", delta)
+        soap_output = "".join(parts)
+        emit("soap", soap_output)
+        return soap_output
     
-    soap_output = call_llm(soap_system, soap_user, llm_mode=llm_mode)
+    def run_fused_analysis() -> Optional[Tuple[str, str, str]]:
+        """
+        Step 1 + Step 2 + SOAP in one structured call, so the context is prefilled once
+        None if the output is unusable (the separate calls are tried instead); a provider
+        error is returned as-is, since retrying the same provider three more times would fail too
+        """
+        fused_system = "You are a clinical extractor, an expert clinical reasoning engine and a professional medical summarization agent. Using only the context given, extract and organize the facts, reason from them to an evidence-based differential diagnosis, and produce a concise, factual SOAP note."
+        fused_user = f"""CONTEXT:
+{context}
+
+Return a JSON object with three fields:
+"extraction": the facts extracted into categories (no diagnoses here):
+1. Patient History & Demographics:
+2. Chief Complaint & Symptoms:
+3. Physical Exam & Vitals:
+4. Key Lab & Imaging Findings:
+5. Clinician's Stated Assessment:
+Include chunk ids in brackets after each finding.
+"ddx": the top 3-5 differential diagnoses reasoned from the extraction. For EACH diagnosis:
+- "diagnosis": the specific diagnosis name
+- "confidence": "High", "Medium", or "Low" based on how well it fits the clinical picture
+- "rationale": 2-4 sentences on the supporting findings, pathophysiology and why it has this confidence
+- "evidence": list of chunk_id strings that support it
+- "workup": tests/studies to confirm or rule it out
+- "red_flags": concerning findings that require urgent attention
+Include the most likely diagnosis, cannot-miss life-threatening conditions, and common mimics.
+"soap": the SOAP note: S (Subjective), O (Objective), A (Assessment), P (Plan)."""
+        
+        # Streamed: the schema's field order is extraction, ddx, soap, so the facts, each
+        # diagnosis and the SOAP text are emitted as soon as the model writes them
+        parts = []
+        completed = False
+        streamed = False
+        
+        def collect() -> Iterator[str]:
+            nonlocal completed
+            completed = yield from _tee(stream_llm(
+                fused_system, fused_user, max_tokens=2048, llm_mode=llm_mode, json_schema=FUSED_ANALYSIS_JSON_SCHEMA
+            ), parts)
+        
+        try:
+            for kind, key, value in iter_json_object_fields(collect()):
+                if kind == "value" and key == "extraction" and isinstance(value, str):
+                    emit("step1_facts", value)
+                elif kind == "item" and key == "ddx" and _is_ddx_item(value):
+                    emit("ddx_item", value)
+                elif kind == "delta" and key == "soap":
+                    emit("soap_delta", value)
+                else:
+                    continue
+                streamed = True
+        except LLMOutputValidationError:
+            # A rejected generation, not an unreachable provider: the separate calls can still succeed
+            if streamed:
+                emit("reset", None)
+            return None
+        
+        if not completed:
+            error = parts[-1]  # stream_llm yields the provider's error message last
+            emit("step1_facts", error)
+            emit("soap", error)
+            return error, error, error
+        try:
+            fused = parse_ddx_json("".join(parts))
+        except Exception:
+            fused = None
+        if not _is_fused_analysis(fused):
+            if streamed:
+                # The separate calls re-emit every stage, so the client drops what it has so far
+                emit("reset", None)
+            return None
+        step1_output, soap_output, ddx_items = fused["extraction"], fused["soap"], fused["ddx"]
+        emit("soap", soap_output)
+        return step1_output, json.dumps(ddx_items, indent=2), soap_output
+    
+    async def run_llm_stages() -> Tuple[str, str, str]:
+        fused = None
+        if llm_mode in FUSED_LLM_MODES:
+            fused = await asyncio.to_thread(run_fused_analysis)
+        
+        if fused is not None:
+            return fused
+        
+        # SOAP only needs the context, so it runs concurrently with the Step 1 -> Step 2 chain
+        (step1_output, step2_output), soap_output = await asyncio.gather(
+            asyncio.to_thread(run_facts_and_ddx),
+            asyncio.to_thread(run_soap)
+        )
+        return step1_output, step2_output, soap_output
+    
+    llm_task = asyncio.create_task(run_llm_stages())
+    # Wake the consumer loop once the stages finish; the sentinel queues behind any pending emits
+    llm_task.add_done_callback(lambda _: loop.call_soon(events.put_nowait, None))
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+        step1_output, step2_output, soap_output = llm_task.result()
+    finally:
+        llm_task.cancel()
     
     # Parse DDx JSON
     ddx_json = None
     parse_error = None
     try:
-        ddx_json = json.loads(step2_output)
+        ddx_json = parse_ddx_json(step2_output)
     except Exception as e:
         parse_error = str(e)
     
     processing_time = time.time() - start_time
     
-    return {
+    yield {"event": "result", "data": {
         "soap": soap_output,
         "step1_facts": step1_output,
         "step2_ddx_raw": step2_output,
@@ -738,4 +1772,17 @@ Return ONLY valid JSON array, no other text."""
         "retrieved_chunks": retrieved,
         "all_chunks": chunks,
         "processing_time": processing_time
-    }
+    }}
+
+
+async def analyze_clinical_note(
+    full_text: str,
+    llm_mode: str = "local_stub",
+    top_k: int = 6,
+    use_small_embedder: bool = True
+) -> Dict[str, Any]:
+    """Main RAG pipeline - analyze clinical note (non-streaming; returns the final result)"""
+    async for event in stream_clinical_note_analysis(full_text, llm_mode, top_k, use_small_embedder):
+        if event["event"] == "result":
+            return event["data"]
+    raise RuntimeError("Analysis pipeline finished without a result")
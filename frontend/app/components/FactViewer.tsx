@@ -1,6 +1,6 @@
 'use client';
 
-import React from 'react';
+import React, { memo } from 'react';
 import { cn } from '@/lib/utils';
 import { FileSearch } from 'lucide-react';
 
@@ -9,7 +9,7 @@ interface FactViewerProps {
     onHover: (ids: string[] | null) => void;
 }
 
-export default function FactViewer({ text, onHover }: FactViewerProps) {
+function FactViewer({ text, onHover }: FactViewerProps) {
     if (!text) return null;
 
     // Split text by lines to handle formatting
@@ -70,3 +70,6 @@ export default function FactViewer({ text, onHover }: FactViewerProps) {
         </div>
     );
 }
+
+// Memoized so hovering evidence (which updates page state) doesn't re-parse the facts text
+export default memo(FactViewer);
@@ -1,6 +1,6 @@
 'use client';
 
-import React, { useRef, useEffect } from 'react';
+import React, { memo, useMemo, useRef, useEffect } from 'react';
 import { ChunkInfo } from '@/lib/api';
 import { cn } from '@/lib/utils';
 import { FileText, Search } from 'lucide-react';
@@ -10,19 +10,48 @@ interface SourceViewerProps {
     highlightedIds: string[] | null;
 }
 
-export default function SourceViewer({ chunks, highlightedIds }: SourceViewerProps) {
+interface ChunkSpanProps {
+    chunk: ChunkInfo;
+    isHighlighted: boolean;
+}
+
+// Memoized so a highlight change only re-renders the spans whose state flipped,
+// instead of rebuilding every segment of the document on each hover.
+const ChunkSpan = memo(function ChunkSpan({ chunk, isHighlighted }: ChunkSpanProps) {
+    return (
+        <span
+            data-highlighted={isHighlighted || undefined}
+            className={cn(
+                "transition-colors duration-300 rounded px-0.5 box-decoration-clone",
+                isHighlighted
+                    ? "bg-yellow-200 dark:bg-yellow-500/40 text-slate-900 dark:text-white font-medium ring-2 ring-yellow-400/50"
+                    : "text-slate-600 dark:text-slate-400 hover:bg-slate-100 dark:hover:bg-white/5"
+            )}
+            title={`ID: ${chunk.chunk_id} | Section: ${chunk.section}`}
+        >
+            {chunk.text}
+        </span>
+    );
+});
+
+function SourceViewer({ chunks, highlightedIds }: SourceViewerProps) {
     const containerRef = useRef<HTMLDivElement>(null);
-    const highlightedRef = useRef<HTMLSpanElement>(null);
 
     // Filter out duplicate or unlabeled chunks if needed, but usually we show all for context
     // Ideally we reconstruct the full text or show chunks in order
     // Since chunks are sequential, we can just map them.
-    const sortedChunks = [...(chunks || [])].sort((a, b) => (a.chunk_num || 0) - (b.chunk_num || 0));
+    const sortedChunks = useMemo(
+        () => [...(chunks || [])].sort((a, b) => (a.chunk_num || 0) - (b.chunk_num || 0)),
+        [chunks]
+    );
+    const highlightedSet = useMemo(() => new Set(highlightedIds || []), [highlightedIds]);
 
     // Scroll to highlight
     useEffect(() => {
-        if (highlightedIds && highlightedIds.length > 0 && highlightedRef.current) {
-            highlightedRef.current.scrollIntoView({
+        if (!highlightedIds || highlightedIds.length === 0 || !containerRef.current) return;
+        const target = containerRef.current.querySelector('[data-highlighted]');
+        if (target) {
+            target.scrollIntoView({
                 behavior: 'smooth',
                 block: 'center',
             });
@@ -52,26 +81,18 @@ export default function SourceViewer({ chunks, highlightedIds }: SourceViewerPro
                 ref={containerRef}
                 className="flex-1 overflow-y-auto p-4 space-y-1 font-mono text-sm leading-relaxed"
             >
-                {sortedChunks.map((chunk, idx) => {
-                    const isHighlighted = highlightedIds?.includes(chunk.chunk_id);
-                    // Add newline if section changes or usually just render text with whitespace preserved
-                    return (
-                        <span
-                            key={chunk.chunk_id}
-                            ref={isHighlighted ? highlightedRef : null}
-                            className={cn(
-                                "transition-colors duration-300 rounded px-0.5 box-decoration-clone",
-                                isHighlighted
-                                    ? "bg-yellow-200 dark:bg-yellow-500/40 text-slate-900 dark:text-white font-medium ring-2 ring-yellow-400/50"
-                                    : "text-slate-600 dark:text-slate-400 hover:bg-slate-100 dark:hover:bg-white/5"
-                            )}
-                            title={`ID: ${chunk.chunk_id} | Section: ${chunk.section}`}
-                        >
-                            {chunk.text}
-                        </span>
-                    );
-                })}
+                {sortedChunks.map((chunk) => (
+                    <ChunkSpan
+                        key={chunk.chunk_id}
+                        chunk={chunk}
+                        isHighlighted={highlightedSet.has(chunk.chunk_id)}
+                    />
+                ))}
             </div>
         </div>
     );
 }
+
+// Memoized so page-level state changes (copy buttons, patient letter, voice dictation)
+// don't re-render the source document; only new chunks or highlights do.
+export default memo(SourceViewer);
@@ -54,6 +54,11 @@ export default function Home() {
   const [isAnalyzing, setIsAnalyzing] = useState(false);
   const [isProcessingOCR, setIsProcessingOCR] = useState(false);
   const [result, setResult] = useState<AnalysisResponse | null>(null);
+  const [partialResult, setPartialResult] = useState<{ step1_facts: string; soap: string; ddx: DiagnosisItem[] }>({
+    step1_facts: '',
+    soap: '',
+    ddx: [],
+  });
   const [error, setError] = useState<string | null>(null);
   const [llmMode, setLlmMode] = useState<string>('ollama');
   const [selectedDiagnosis, setSelectedDiagnosis] = useState<string | null>(null);
@@ -194,16 +199,34 @@ export default function Home() {
     setIsAnalyzing(true);
     setError(null);
     setResult(null);
+    setPartialResult({ step1_facts: '', soap: '', ddx: [] });
     setSelectedDiagnosis(null);
     setActiveTab('diagnosis'); // Switch to results tab while analyzing
 
     try {
-      const response = await clinicalAPI.analyze({
-        text: noteText,
-        llm_mode: llmMode,
-        top_k: 6,
-        use_small_embedder: false,
-      });
+      // Stream the pipeline so facts, SOAP text and diagnoses show up as each stage produces them
+      const response = await clinicalAPI.analyzeStream(
+        {
+          text: noteText,
+          llm_mode: llmMode,
+          top_k: 6,
+          use_small_embedder: true,
+        },
+        ({ event, data }) => {
+          if (event === 'step1_facts') {
+            setPartialResult((prev) => ({ ...prev, step1_facts: data }));
+          } else if (event === 'soap_delta') {
+            setPartialResult((prev) => ({ ...prev, soap: prev.soap + data }));
+          } else if (event === 'soap') {
+            setPartialResult((prev) => ({ ...prev, soap: data }));
+          } else if (event === 'ddx_item') {
+            setPartialResult((prev) => ({ ...prev, ddx: [...prev.ddx, data] }));
+          } else if (event === 'reset') {
+            // Backend is re-running the stages separately; they will be streamed again
+            setPartialResult({ step1_facts: '', soap: '', ddx: [] });
+          }
+        }
+      );
 
       setResult(response);
     } catch (err: any) {
@@ -499,6 +522,40 @@ export default function Home() {
                       </motion.div>
                     ))}
                   </div>
+
+                  {/* Partial output streamed from the backend */}
+                  {(partialResult.step1_facts || partialResult.ddx.length > 0 || partialResult.soap) && (
+                    <div className="w-full max-w-2xl mt-8 space-y-4 text-left">
+                      {partialResult.step1_facts && (
+                        <div className="p-4 rounded-lg bg-white/50 dark:bg-slate-900/50">
+                          <h4 className="text-sm font-semibold text-slate-900 dark:text-white mb-2">Clinical Facts</h4>
+                          <pre className="whitespace-pre-wrap text-sm text-slate-700 dark:text-slate-300 font-sans max-h-48 overflow-y-auto">
+                            {partialResult.step1_facts}
+                          </pre>
+                        </div>
+                      )}
+                      {partialResult.ddx.length > 0 && (
+                        <div className="p-4 rounded-lg bg-white/50 dark:bg-slate-900/50">
+                          <h4 className="text-sm font-semibold text-slate-900 dark:text-white mb-2">Differential Diagnoses</h4>
+                          <ul className="space-y-1">
+                            {partialResult.ddx.map((dx, idx) => (
+                              <li key={idx} className="text-sm text-slate-700 dark:text-slate-300">
+                                {idx + 1}. {dx.diagnosis} <span className="text-xs text-slate-500">({dx.confidence})</span>
+                              </li>
+                            ))}
+                          </ul>
+                        </div>
+                      )}
+                      {partialResult.soap && (
+                        <div className="p-4 rounded-lg bg-white/50 dark:bg-slate-900/50">
+                          <h4 className="text-sm font-semibold text-slate-900 dark:text-white mb-2">SOAP Summary</h4>
+                          <pre className="whitespace-pre-wrap text-sm text-slate-700 dark:text-slate-300 font-sans">
+                            {partialResult.soap}
+                          </pre>
+                        </div>
+                      )}
+                    </div>
+                  )}
                 </div>
               )}
 
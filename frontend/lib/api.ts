@@ -46,6 +46,11 @@ export interface AnalysisResponse {
   processing_time: number;
 }
 
+export interface AnalysisStreamEvent {
+  event: 'retrieved' | 'step1_facts' | 'soap_delta' | 'soap' | 'ddx_item' | 'reset' | 'result' | 'error';
+  data: any;
+}
+
 export interface OCRResponse {
   text: string;
   success: boolean;
@@ -97,12 +102,76 @@ export const clinicalAPI = {
     return response.data;
   },
 
-  // Analyze clinical note
+  // Analyze clinical note in one request (non-streaming; analyzeStream falls back to this)
   analyze: async (data: AnalysisRequest): Promise<AnalysisResponse> => {
     const response = await api.post('/api/analysis/analyze', data);
     return response.data;
   },
 
+  // Analyze clinical note, receiving each pipeline stage as it finishes (NDJSON stream)
+  analyzeStream: async (
+    data: AnalysisRequest,
+    onEvent: (event: AnalysisStreamEvent) => void
+  ): Promise<AnalysisResponse> => {
+    if (typeof ReadableStream === 'undefined' || typeof TextDecoder === 'undefined') {
+      // No streamed response bodies in this browser: one blocking request, delivered as the result event
+      const result = await clinicalAPI.analyze(data);
+      onEvent({ event: 'result', data: result });
+      return result;
+    }
+
+    const response = await fetch(`${API_URL}/api/analysis/analyze/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(data),
+    });
+    if (!response.ok || !response.body) {
+      // Surface FastAPI's `detail` (e.g. a 400 for an empty note) like the axios calls do
+      let message = `Analysis failed: ${response.status} ${response.statusText}`;
+      try {
+        const body = await response.json();
+        if (body?.detail) {
+          message = typeof body.detail === 'object' ? JSON.stringify(body.detail) : body.detail;
+        }
+      } catch {
+        // Non-JSON error body; keep the status line
+      }
+      throw new Error(message);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result: AnalysisResponse | null = null;
+
+    const handleLine = (line: string) => {
+      if (!line.trim()) return;
+      const event: AnalysisStreamEvent = JSON.parse(line);
+      if (event.event === 'error') {
+        throw new Error(event.data);
+      }
+      if (event.event === 'result') {
+        result = event.data;
+      }
+      onEvent(event);
+    };
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop() ?? '';
+      lines.forEach(handleLine);
+    }
+    handleLine(buffer + decoder.decode());
+
+    if (!result) {
+      throw new Error('Analysis stream ended without a result');
+    }
+    return result;
+  },
+
   // OCR
   extractText: async (imageBase64: string): Promise<OCRResponse> => {
     const response = await api.post('/api/ocr/extract', {